@@ -11,4 +11,4 @@ echo "Installing requirements..."
 python3 -m pip install -r requirements.txt || python -m pip install -r requirements.txt
 
 echo "Starting application..."
-exec python3 -m uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001} || exec python -m uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001}
+exec python3 -m uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001} --loop uvloop --http httptools --ws-per-message-deflate false || exec python -m uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001} --loop uvloop --http httptools --ws-per-message-deflate false
@@ -4,4 +4,4 @@ echo "Python version: $(python --version)"
 echo "Installing dependencies..."
 pip install -r requirements.txt
 echo "Starting FastAPI server..."
-uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001} --log-level info
+uvicorn videocalling:app --host 0.0.0.0 --port ${PORT:-8001} --loop uvloop --http httptools --ws-per-message-deflate false --log-level info
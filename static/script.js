@@ -18,6 +18,7 @@ class VideoCallApp {
         this.reconnectAttempts = 0;
         this.maxReconnectAttempts = 5;
         this.webrtcConfig = null;
+        this.textEncoder = new TextEncoder();
         
         // Bind methods to preserve context
         this.handleSignaling = this.handleSignaling.bind(this);
@@ -233,7 +234,8 @@ class VideoCallApp {
         console.log('Connecting to room:', roomId);
         return new Promise((resolve, reject) => {
             const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            const wsUrl = `${protocol}//${window.location.host}/ws/${roomId}`;
+            // batch=1 tells the server this client can unpack batched frames
+            const wsUrl = `${protocol}//${window.location.host}/ws/${roomId}?batch=1`;
             console.log('WebSocket URL:', wsUrl);
             
             this.socket = new WebSocket(wsUrl);
@@ -263,8 +265,12 @@ class VideoCallApp {
     handleSocketMessage(event) {
         try {
             const message = JSON.parse(event.data);
-            console.log('Received WebSocket message:', message.type);
-            this.handleSignaling(message);
+            // The server coalesces queued messages into a single batch frame
+            const messages = message.type === 'batch' ? message.items : [message];
+            for (const item of messages) {
+                console.log('Received WebSocket message:', item.type);
+                this.handleSignaling(item);
+            }
         } catch (error) {
             console.error('Error parsing WebSocket message:', error);
         }
@@ -504,7 +510,8 @@ class VideoCallApp {
     sendSignaling(message) {
         if (this.socket && this.socket.readyState === WebSocket.OPEN) {
             try {
-                this.socket.send(JSON.stringify(message));
+                // Send as a binary frame so the server can parse the bytes directly
+                this.socket.send(this.textEncoder.encode(JSON.stringify(message)));
                 console.log('Sent signaling message:', message.type);
             } catch (error) {
                 console.error('Error sending signaling message:', error);
@@ -3,33 +3,62 @@ Video Calling WebRTC Signaling Server
 This module handles WebRTC signaling for video calls between peers.
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, List, Optional
-import json
+from typing import Dict, Optional, Tuple
+import orjson
 import logging
 import os
 import asyncio
+import hashlib
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import datetime
 from contextlib import asynccontextmanager
 
 # Setup logging
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Maximum time (seconds) to wait on a single socket write before dropping the peer
+SEND_TIMEOUT = 2.0
+
+# Maximum number of outbound messages buffered per user before the peer is dropped.
+# Worst-case buffered memory is roughly peers x OUTBOUND_QUEUE_SIZE x message size.
+OUTBOUND_QUEUE_SIZE = 128
+
+# Limits for coalescing queued messages into a single "batch" frame. Only clients
+# that connect with ?batch=1 understand batch frames. The size limit counts
+# characters of the serialized JSON text, not encoded bytes.
+MAX_BATCH_ITEMS = 64
+MAX_BATCH_CHARS = 64 * 1024
+
+# Users who send nothing for IDLE_TIMEOUT seconds are disconnected by a watchdog
+# that wakes every IDLE_CHECK_INTERVAL seconds
+IDLE_TIMEOUT = 300.0
+IDLE_CHECK_INTERVAL = 60.0
+
+# Random per-process token included in room info ETags, so versions from another
+# process (or a previous run) never validate against this one
+BOOT_ID = uuid.uuid4().hex
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Video calling server starting up...")
-    logger.info(f"Static files directory: {os.path.abspath('static')}")
+    logger.info("Static files directory: %s", os.path.abspath('static'))
+    logger.info("Event loop: %s", type(asyncio.get_running_loop()).__module__)
+    
+    idle_watchdog = asyncio.create_task(connection_manager.idle_watchdog())
     yield
     # Shutdown
+    idle_watchdog.cancel()
     logger.info("Video calling server shutting down...")
 
 # Create FastAPI app
@@ -40,150 +69,271 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Add CORS middleware only when the frontend is hosted on another origin.
+# The bundled frontend is same-origin, and CORS doesn't apply to WebSockets.
+allowed_origins = [o.strip() for o in os.environ.get("ALLOWED_ORIGINS", "").split(",") if o.strip()]
+if allowed_origins:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=allowed_origins,
+        allow_credentials=True,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type"],
+    )
+
+@dataclass(slots=True)
+class User:
+    """Per-connection state for a user in a room"""
+    websocket: WebSocket
+    room_id: str
+    joined_at: float  # time.monotonic()
+    queue: asyncio.Queue
+    writer: asyncio.Task
+    last_seen: float  # time.monotonic() of the last inbound message
 
 class ConnectionManager:
     """Enhanced connection manager with better tracking and error handling"""
     
     def __init__(self):
-        self.connections: Dict[str, WebSocket] = {}
-        self.user_rooms: Dict[str, str] = {}  # user_id -> room_id
-        self.room_users: Dict[str, List[str]] = {}  # room_id -> [user_ids]
-        self.user_info: Dict[str, Dict] = {}  # user_id -> {websocket, joined_at, etc}
+        self.users: Dict[str, User] = {}  # user_id -> User
+        self.room_users: Dict[str, Dict[str, User]] = {}  # room_id -> {user_id: User}
+        # Guards users/room_users; never held across a socket send
+        self._lock = asyncio.Lock()
+        # Room membership versions for caching the room info API response.
+        # Drawn from one counter so a re-created room never reuses an old version
+        # within this process; ETags also carry BOOT_ID to cover other processes.
+        self._version_counter = 0
+        self._room_version: Dict[str, int] = {}  # room_id -> version
+        self._room_info_cache: Dict[str, Tuple[int, bytes]] = {}  # room_id -> (version, JSON body)
     
     def generate_user_id(self) -> str:
         """Generate unique user ID"""
         return str(uuid.uuid4())
     
-    async def connect_user(self, websocket: WebSocket, room_id: str) -> str:
+    @staticmethod
+    def _make_user_joined(user_id: str, room_size: int) -> Dict:
+        """Build the notification broadcast when a user joins a room"""
+        return {
+            "type": "user-joined",
+            "user_id": user_id,
+            "message": "A new user joined the call",
+            "room_size": room_size
+        }
+    
+    @staticmethod
+    def _make_user_left(user_id: str, room_size: int) -> Dict:
+        """Build the notification broadcast when a user leaves a room"""
+        return {
+            "type": "user-left",
+            "user_id": user_id,
+            "message": "A user left the call",
+            "room_size": room_size
+        }
+    
+    @staticmethod
+    def _make_room_info(room_id: str, user_id: str, room_size: int) -> Dict:
+        """Build the room-info message sent to a newly joined user"""
+        return {
+            "type": "room-info",
+            "room_id": room_id,
+            "user_id": user_id,
+            "room_size": room_size,
+            "is_initiator": room_size == 1
+        }
+    
+    async def connect_user(self, websocket: WebSocket, room_id: str, batching: bool = False) -> str:
         """Connect a user to a room and return user ID"""
         await websocket.accept()
         
         user_id = self.generate_user_id()
         
-        # Store user information
-        self.connections[user_id] = websocket
-        self.user_rooms[user_id] = room_id
-        self.user_info[user_id] = {
-            'websocket': websocket,
-            'room_id': room_id,
-            'joined_at': datetime.now(),
-            'is_connected': True
-        }
+        # Outbound messages are queued and written by a dedicated task per user
+        queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        max_batch_items = MAX_BATCH_ITEMS if batching else 1
+        writer = asyncio.create_task(self._writer(user_id, websocket, queue, max_batch_items))
         
-        # Add user to room
-        if room_id not in self.room_users:
-            self.room_users[room_id] = []
-        self.room_users[room_id].append(user_id)
+        # Store user information and add user to room
+        now = time.monotonic()
+        user = User(websocket, room_id, now, queue, writer, now)
+        async with self._lock:
+            self.users[user_id] = user
+            room = self.room_users.setdefault(room_id, {})
+            room[user_id] = user
+            room_size = len(room)
+            self._bump_room_version(room_id)
         
-        logger.info(f"User {user_id} joined room {room_id}. Total users in room: {len(self.room_users[room_id])}")
+        logger.info("User %s joined room %s. Total users in room: %d", user_id, room_id, room_size)
         
-        # Notify other users in the room about new user
-        await self.broadcast_to_room(room_id, {
-            "type": "user-joined",
-            "user_id": user_id,
-            "message": "A new user joined the call",
-            "room_size": len(self.room_users[room_id])
-        }, exclude_user=user_id)
+        # Send current room info to the new user first so their call setup starts right away
+        await self.send_to_user(user_id, self._make_room_info(room_id, user_id, room_size))
         
-        # Send current room info to the new user
-        await self.send_to_user(user_id, {
-            "type": "room-info",
-            "room_id": room_id,
-            "user_id": user_id,
-            "room_size": len(self.room_users[room_id]),
-            "is_initiator": len(self.room_users[room_id]) == 1
-        })
+        # Notify other users in the room about new user (nobody to tell if we're first)
+        if room_size > 1:
+            await self.broadcast_to_room(room_id, self._make_user_joined(user_id, room_size), exclude_user=user_id)
         
         return user_id
     
     async def disconnect_user(self, user_id: str):
         """Disconnect a user and clean up"""
-        if user_id not in self.user_info:
-            return
-        
-        user_info = self.user_info[user_id]
-        room_id = user_info['room_id']
-        
-        # Remove user from room
-        if room_id in self.room_users and user_id in self.room_users[room_id]:
-            self.room_users[room_id].remove(user_id)
+        # Remove user data and room membership
+        async with self._lock:
+            user = self.users.pop(user_id, None)
+            if user is None:
+                return
+            
+            room_id = user.room_id
+            room = self.room_users.get(room_id)
+            removed = room is not None and room.pop(user_id, None) is not None
+            room_size = len(room) if removed else 0
             
             # Clean up empty rooms
-            if not self.room_users[room_id]:
+            if removed and not room:
                 del self.room_users[room_id]
-                logger.info(f"Room {room_id} is now empty and has been removed")
+                self._room_version.pop(room_id, None)
+                self._room_info_cache.pop(room_id, None)
+            elif removed:
+                self._bump_room_version(room_id)
+        
+        # Stop the writer task (unless it is the one tearing the user down)
+        if user.writer is not asyncio.current_task():
+            user.writer.cancel()
+        
+        if removed:
+            if not room_size:
+                logger.info("Room %s is now empty and has been removed", room_id)
             else:
                 # Notify remaining users
-                await self.broadcast_to_room(room_id, {
-                    "type": "user-left",
-                    "user_id": user_id,
-                    "message": "A user left the call",
-                    "room_size": len(self.room_users[room_id])
-                })
+                await self.broadcast_to_room(room_id, self._make_user_left(user_id, room_size))
         
-        # Clean up user data
-        self.connections.pop(user_id, None)
-        self.user_rooms.pop(user_id, None)
-        self.user_info.pop(user_id, None)
-        
-        logger.info(f"User {user_id} disconnected from room {room_id}")
+        logger.info("User %s disconnected from room %s", user_id, room_id)
     
     async def handle_message(self, user_id: str, message: dict):
         """Handle incoming messages from users"""
-        if user_id not in self.user_info:
-            logger.warning(f"Received message from unknown user {user_id}")
+        user = self.users.get(user_id)
+        if user is None:
+            logger.warning("Received message from unknown user %s", user_id)
             return
         
-        room_id = self.user_info[user_id]['room_id']
-        message_type = message.get('type', 'unknown')
+        room_id = user.room_id
         
-        logger.info(f"Handling {message_type} message from user {user_id} in room {room_id}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Handling %s message from user %s in room %s", message.get('type', 'unknown'), user_id, room_id)
         
         # Add sender information to message
         message['sender_id'] = user_id
-        message['timestamp'] = datetime.now().isoformat()
         
         # Broadcast message to other users in the room
         await self.broadcast_to_room(room_id, message, exclude_user=user_id)
     
+    async def _writer(self, user_id: str, websocket: WebSocket, queue: asyncio.Queue, max_batch_items: int):
+        """Drain a user's outbound queue onto their WebSocket"""
+        try:
+            while True:
+                payload = await queue.get()
+                
+                # Coalesce whatever else is already waiting into one frame
+                batch = [payload]
+                batch_size = len(payload)
+                while not queue.empty() and len(batch) < max_batch_items and batch_size < MAX_BATCH_CHARS:
+                    payload = queue.get_nowait()
+                    batch.append(payload)
+                    batch_size += len(payload)
+                
+                if len(batch) > 1:
+                    payload = '{"type":"batch","items":[' + ','.join(batch) + ']}'
+                
+                await asyncio.wait_for(websocket.send_text(payload), timeout=SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Send to user %s timed out after %ss, dropping connection", user_id, SEND_TIMEOUT)
+        except Exception as e:
+            logger.error("Error sending message to user %s: %s", user_id, e)
+        finally:
+            # Close the socket (also when cancelled) so the receive loop for this user ends too
+            try:
+                await asyncio.wait_for(websocket.close(code=1011), timeout=SEND_TIMEOUT)
+            except Exception:
+                pass
+        
+        await self.disconnect_user(user_id)
+    
+    async def idle_watchdog(self):
+        """Periodically disconnect users that have been silent for too long"""
+        while True:
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+            now = time.monotonic()
+            idle_users = [(user_id, user) for user_id, user in self.users.items() if now - user.last_seen > IDLE_TIMEOUT]
+            for user_id, user in idle_users:
+                # Earlier reaps await socket closes, so re-check against live state:
+                # skip users that have since sent a frame or already left
+                if self.users.get(user_id) is not user or time.monotonic() - user.last_seen <= IDLE_TIMEOUT:
+                    continue
+                # A failure for one user must not kill the watchdog for everyone
+                try:
+                    logger.warning("WebSocket timeout for user %s", user_id)
+                    # Close normally (no client reconnect); this also ends the receive loop
+                    try:
+                        await asyncio.wait_for(user.websocket.close(code=1000), timeout=SEND_TIMEOUT)
+                    except Exception:
+                        pass
+                    await self.disconnect_user(user_id)
+                except Exception:
+                    logger.exception("Idle watchdog failed to disconnect user %s", user_id)
+    
+    def _enqueue(self, user: User, user_id: str, payload: str) -> bool:
+        """Queue a serialized message for a user; returns False if the user can't keep up"""
+        try:
+            user.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Outbound queue full for user %s, dropping connection", user_id)
+            return False
+    
     async def send_to_user(self, user_id: str, message: dict):
         """Send message to a specific user"""
-        if user_id in self.connections:
-            try:
-                websocket = self.connections[user_id]
-                await websocket.send_json(message)
-            except Exception as e:
-                logger.error(f"Error sending message to user {user_id}: {e}")
+        user = self.users.get(user_id)
+        if user is not None:
+            if not self._enqueue(user, user_id, orjson.dumps(message).decode()):
                 await self.disconnect_user(user_id)
     
     async def broadcast_to_room(self, room_id: str, message: dict, exclude_user: Optional[str] = None):
         """Send message to all users in a room except the sender"""
-        if room_id not in self.room_users:
-            return
-        
+        # Snapshot recipients under the lock; queueing happens outside it
+        async with self._lock:
+            room = self.room_users.get(room_id)
+            if room is None:
+                return
+            targets = [(user_id, user) for user_id, user in room.items() if user_id != exclude_user]
+
+        # Serialize once and reuse the encoded frame for every recipient
+        payload = orjson.dumps(message).decode()
+
         disconnected_users = []
-        
-        for user_id in self.room_users[room_id]:
-            if user_id != exclude_user and user_id in self.connections:
-                try:
-                    websocket = self.connections[user_id]
-                    await websocket.send_json(message)
-                except Exception as e:
-                    logger.error(f"Error broadcasting to user {user_id}: {e}")
-                    disconnected_users.append(user_id)
-        
-        # Clean up disconnected users
+
+        for user_id, user in targets:
+            if not self._enqueue(user, user_id, payload):
+                disconnected_users.append(user_id)
+
+        # Clean up peers that fell too far behind (re-acquires the lock)
         for user_id in disconnected_users:
             await self.disconnect_user(user_id)
     
+    def _bump_room_version(self, room_id: str):
+        """Mark a room's membership as changed"""
+        self._version_counter += 1
+        self._room_version[room_id] = self._version_counter
+    
+    def get_room_info_json(self, room_id: str) -> Tuple[Optional[int], bytes]:
+        """Get the encoded room info and its version (None if the room doesn't exist)"""
+        version = self._room_version.get(room_id)
+        if version is None:
+            return None, orjson.dumps(self.get_room_info(room_id))
+        
+        cached = self._room_info_cache.get(room_id)
+        if cached is None or cached[0] != version:
+            cached = (version, orjson.dumps(self.get_room_info(room_id)))
+            self._room_info_cache[room_id] = cached
+        return cached
+    
     def get_room_info(self, room_id: str) -> Dict:
         """Get information about a room"""
         if room_id not in self.room_users:
@@ -193,7 +343,7 @@ class ConnectionManager:
             "exists": True,
             "room_id": room_id,
             "user_count": len(self.room_users[room_id]),
-            "users": self.room_users[room_id]
+            "users": list(self.room_users[room_id])
         }
 
 # Global connection manager instance
@@ -211,22 +361,38 @@ WEBRTC_CONFIG = {
     "iceCandidatePoolSize": 10
 }
 
+# The config never changes at runtime, so encode it once for the API endpoint
+WEBRTC_CONFIG_JSON = orjson.dumps(WEBRTC_CONFIG)
+
 # Create static directory if it doesn't exist
 static_dir = "static"
 if not os.path.exists(static_dir):
     os.makedirs(static_dir)
-    logger.info(f"Created static directory: {static_dir}")
+    logger.info("Created static directory: %s", static_dir)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
+# index.html is static for the life of the process, so serve it from memory
+try:
+    with open(os.path.join(static_dir, 'index.html'), 'rb') as f:
+        INDEX_HTML: Optional[bytes] = f.read()
+    INDEX_ETAG = f'"{hashlib.md5(INDEX_HTML, usedforsecurity=False).hexdigest()}"'
+except FileNotFoundError:
+    logger.warning("Index file not found in %s", os.path.abspath(static_dir))
+    INDEX_HTML = None
+    INDEX_ETAG = None
+
 @app.get("/")
-async def read_index():
+async def read_index(request: Request):
     """Serve the main page"""
-    try:
-        return FileResponse('static/index.html')
-    except FileNotFoundError:
+    if INDEX_HTML is None:
         raise HTTPException(status_code=404, detail="Index file not found")
+    
+    headers = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=3600"}
+    if INDEX_ETAG in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=INDEX_HTML, media_type="text/html", headers=headers)
 
 @app.get("/health")
 async def health_check():
@@ -238,15 +404,21 @@ async def health_check():
     }
 
 @app.get("/api/rooms/{room_id}/info")
-async def get_room_info(room_id: str):
+async def get_room_info(room_id: str, request: Request):
     """Get information about a specific room"""
-    room_info = connection_manager.get_room_info(room_id)
-    return room_info
+    version, body = connection_manager.get_room_info_json(room_id)
+    if version is None:
+        return Response(content=body, media_type="application/json")
+    
+    etag = f'"{BOOT_ID}-{version}"'
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 @app.get("/api/webrtc-config")
 async def get_webrtc_config():
     """Get WebRTC configuration for clients"""
-    return WEBRTC_CONFIG
+    return Response(content=WEBRTC_CONFIG_JSON, media_type="application/json")
 
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str):
@@ -260,33 +432,45 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
             return
         
         # Connect user to room
-        user_id = await connection_manager.connect_user(websocket, room_id)
-        logger.info(f"User {user_id} connected to room {room_id}")
+        # Only clients that opt in understand batched frames
+        batching = websocket.query_params.get("batch") == "1"
+        user_id = await connection_manager.connect_user(websocket, room_id, batching)
+        user = connection_manager.users.get(user_id)
+        logger.info("User %s connected to room %s", user_id, room_id)
         
         # Message handling loop
         while True:
             try:
-                # Wait for message with timeout
-                data = await asyncio.wait_for(websocket.receive_json(), timeout=300.0)  # 5 minute timeout
+                # Idle connections are reaped by ConnectionManager.idle_watchdog
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+                
+                # Any inbound frame counts as activity, even one that fails to parse
+                if user is not None:
+                    user.last_seen = time.monotonic()
+                
+                # Binary frames go straight to orjson; text frames are still accepted
+                raw = message.get("bytes")
+                data = orjson.loads(raw if raw is not None else message.get("text"))
                 await connection_manager.handle_message(user_id, data)
                 
-            except asyncio.TimeoutError:
-                logger.warning(f"WebSocket timeout for user {user_id}")
-                break
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON from user {user_id}: {e}")
+            except orjson.JSONDecodeError as e:
+                logger.error("Invalid JSON from user %s: %s", user_id, e)
                 await connection_manager.send_to_user(user_id, {
                     "type": "error",
                     "message": "Invalid message format"
                 })
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
-                logger.error(f"Error processing message from user {user_id}: {e}")
+                logger.error("Error processing message from user %s: %s", user_id, e)
                 break
                 
     except WebSocketDisconnect:
-        logger.info(f"User {user_id} disconnected normally")
+        logger.info("User %s disconnected normally", user_id)
     except Exception as e:
-        logger.error(f"WebSocket error for user {user_id}: {e}")
+        logger.error("WebSocket error for user %s: %s", user_id, e)
     finally:
         if user_id:
             await connection_manager.disconnect_user(user_id)
@@ -303,7 +487,7 @@ async def not_found_handler(request, exc):
 @app.exception_handler(500)
 async def internal_error_handler(request, exc):
     from fastapi.responses import JSONResponse
-    logger.error(f"Internal server error: {exc}")
+    logger.error("Internal server error: %s", exc)
     return JSONResponse(
         status_code=500,
         content={"error": "Internal server error"}
@@ -313,17 +497,23 @@ async def internal_error_handler(request, exc):
 if __name__ == "__main__":
     import uvicorn
     import os
+    import sys
     
     # Configuration - Use environment variable for port (for deployment)
     port = int(os.environ.get("PORT", 8001))
     config = {
         "host": "0.0.0.0",
         "port": port,
-        "log_level": "info",
+        "log_level": os.environ.get("LOG_LEVEL", "info").lower(),
         "access_log": True,
-        "reload": False
+        "reload": False,
+        # uvloop/httptools ship with uvicorn[standard] but uvloop has no Windows build
+        "loop": "asyncio" if sys.platform == "win32" else "uvloop",
+        "http": "httptools",
+        # Signaling frames are small JSON; per-frame zlib costs more than it saves
+        "ws_per_message_deflate": False
     }
     
-    logger.info(f"Starting server with config: {config}")
+    logger.info("Starting server with config: %s", config)
     uvicorn.run(app, **config)
 